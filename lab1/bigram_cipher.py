@@ -1,6 +1,12 @@
 # ключевое слово: криптекс
 
 import argparse
+import contextlib
+import functools
+from itertools import chain
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from trace_io import CHUNK_SIZE, QUIET, RESULT, SYMBOLS, TraceWriter, print_file, read_chunks
 
 def create_table(key: str, cols: int):
     n = len(key)
@@ -15,44 +21,82 @@ def create_table(key: str, cols: int):
                 pos[ch] = (r, c)
     return table, pos, rows, cols
 
-def create_bigrams(plaintext: str, key: str) -> list:
-    bigrams = []
+@functools.lru_cache(maxsize=None)
+def pair_tables(key: str, cols: int) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Encrypt and decrypt substitutions for every pair of key symbols, e.g. enc["АБ"] == "ЦЕ".
+
+    Built once per (key, cols): a key of ~48 symbols has only ~2300 pairs.
+    """
+    table, pos, rows, cols = create_table(key, cols)
+    enc = {}
+    dec = {}
+    for a, (r1, c1) in pos.items():
+        for b, (r2, c2) in pos.items():
+            if r1 == r2:
+                enc[a + b] = table[r1][(c1 + 1) % cols] + table[r2][(c2 + 1) % cols]
+                dec[a + b] = table[r1][(c1 - 1) % cols] + table[r2][(c2 - 1) % cols]
+            elif c1 == c2:
+                enc[a + b] = table[(r1 + 1) % rows][c1] + table[(r2 + 1) % rows][c2]
+                dec[a + b] = table[(r1 - 1) % rows][c1] + table[(r2 - 1) % rows][c2]
+            else:
+                enc[a + b] = dec[a + b] = table[r1][c2] + table[r2][c1]
+    return enc, dec
 
+def iter_bigrams(plaintext: Iterable[str], key: str) -> Iterator[Tuple[str, str]]:
+    """Bigrams of plaintext, same as create_bigrams, produced in one pass.
+
+    A doubled letter rolls back to the last space seen (sp) and inserts another
+    space there, so only the text from sp on and the bigrams made since then are
+    buffered; everything before sp is yielded as soon as sp moves past it.
+    """
     FIRST_OPTION = 0
     SECOND_OPTION = 1
     THIRD_OPTION = 2
     option = FIRST_OPTION
-  
+
+    chars = iter(plaintext)
+    buf = []   # text[base:], with inserted spaces
+    base = 0
+    pending = []  # bigrams made since sp, dropped on rollback
+
+    def available(idx: int) -> bool:
+        while base + len(buf) <= idx:
+            ch = next(chars, None)
+            if ch is None:
+                return False
+            buf.append(ch)
+        return True
+
     i = 0
     space_pos_plaintext = 0
-    last_space_scan = []
-    while i < len(plaintext):
-        a = plaintext[i]
+    while available(i):
+        a = buf[i - base]
         if a not in key:
-           print(f"Symbol '{a}' not in key")
-           exit()
-        if i + 1 < len(plaintext):
-            b = plaintext[i+1]
+            print(f"Symbol '{a}' not in key")
+            exit()
+        if available(i + 1):
+            b = buf[i + 1 - base]
             if b not in key:
                 print(f"Symbol '{b}' not in key")
                 exit()
-            
+
             if a == " " and b == " ":
                 option = FIRST_OPTION
 
             elif a == " ":
                 space_pos_plaintext = i
-                last_space_scan = bigrams.copy()
+                yield from pending
+                pending = []
                 option = THIRD_OPTION
 
             elif b == " ":
                 space_pos_plaintext = i+1
-                last_space_scan = bigrams.copy()
+                yield from pending
+                pending = []
                 option = SECOND_OPTION
 
             if a == b and space_pos_plaintext != -1 and space_pos_plaintext != 0:
-                tmp = plaintext[0:space_pos_plaintext] + " " + plaintext[space_pos_plaintext:len(plaintext)] 
-                plaintext = tmp
+                buf.insert(space_pos_plaintext - base, " ")
 
                 if option == FIRST_OPTION:
                     i = space_pos_plaintext+2
@@ -61,96 +105,139 @@ def create_bigrams(plaintext: str, key: str) -> list:
                 elif option == THIRD_OPTION:
                     i = space_pos_plaintext
 
-                bigrams = last_space_scan.copy()
+                pending = []
                 space_pos_plaintext = -1
 
             elif a == b and space_pos_plaintext == 0:
-                tmp = " " + plaintext
-                plaintext = tmp
+                buf.insert(0, " ")
                 i = space_pos_plaintext
-                bigrams = last_space_scan.copy()
+                pending = []
                 space_pos_plaintext = -1
 
             else:
-                bigrams.append((a, b))
+                pending.append((a, b))
                 i += 2
         else:
-            bigrams.append((a, " "))
+            pending.append((a, " "))
             i += 2
 
-    return bigrams
+        # without a space to roll back to nothing made so far can change
+        if space_pos_plaintext == -1:
+            yield from pending
+            pending = []
 
-def encrypt(plaintext: str, key: str, cols: int) -> str:
+        # text before the rollback point is never read again
+        if space_pos_plaintext == 0:
+            keep = base
+        elif space_pos_plaintext > 0:
+            keep = max(base, space_pos_plaintext - 1)
+        else:
+            keep = min(i, base + len(buf))
+        if keep - base > len(buf) // 2:
+            del buf[:keep - base]
+            base = keep
 
-    if len(key) % cols != 0:
-        print("Incorrect amount of symbols in key")
-        exit()
+    yield from pending
 
-    bigrams = create_bigrams(plaintext, key)
+def create_bigrams(plaintext: str, key: str) -> list:
+    return list(iter_bigrams(plaintext, key))
+
+def substitute(pairs: Iterable[Tuple[str, str]], table: Dict[str, str], label: str,
+               verbosity: int = SYMBOLS, trace: Optional[TraceWriter] = None) -> Iterator[str]:
+    """Substituted pair for each (a, b); label is "c" (encrypt) or "d" (decrypt) in the printed trace."""
+    if verbosity < SYMBOLS and trace is None:
+        for a, b in pairs:
+            yield table[a + b]
+        return
 
-    table, pos, rows, cols = create_table(key, cols)
-    out_chars = []
-
-    for a, b in bigrams:
-        r1, c1 = pos[a]
-        r2, c2 = pos[b]
-
-        if r1 == r2:
-            ca = table[r1][(c1 + 1) % cols]
-            cb = table[r2][(c2 + 1) % cols]
-        elif c1 == c2:
-            ca = table[(r1 + 1) % rows][c1]
-            cb = table[(r2 + 1) % rows][c2]
-        else:
-            ca = table[r1][c2]
-            cb = table[r2][c1]
+    for a, b in pairs:
+        x, y = pair = table[a + b]
+
+        if trace is not None:
+            trace.write(a + b, pair)
+        if verbosity >= SYMBOLS:
+            print(f"a={a!r} => {label}a={x!r}")
+            print(f"b={b!r} => {label}b={y!r}", end="\n\n")
 
-        out_chars.append(ca)
-        out_chars.append(cb)
+        yield pair
 
-        print(f"{a=} => {ca=}")
-        print(f"{b=} => {cb=}", end="\n\n")
+def cipher_pairs(cipher_text: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    symbols = iter(cipher_text)
+    for a in symbols:
+        b = next(symbols, None)
+        if b is None:
+            raise ValueError("Odd number of symbols in cipher text")
+        yield a, b
 
-    cipher_text = "".join(out_chars)
+def encrypt(plaintext: str, key: str, cols: int, verbosity: int = SYMBOLS,
+            trace: Optional[TraceWriter] = None) -> str:
 
-    print(cipher_text)
+    if len(key) % cols != 0:
+        print("Incorrect amount of symbols in key")
+        exit()
+
+    enc, _ = pair_tables(key, cols)
+    cipher_text = "".join(substitute(iter_bigrams(plaintext, key), enc, "c", verbosity, trace))
+
+    if verbosity >= RESULT:
+        print(cipher_text)
     return cipher_text
 
-def decrypt(cipher_text: str, key: str, cols: int) -> str:
+def decrypt(cipher_text: str, key: str, cols: int, verbosity: int = SYMBOLS,
+            trace: Optional[TraceWriter] = None) -> str:
 
     if len(key) % cols != 0:
         print("Incorrect amount of symbols in key")
         exit()
 
-    table, pos, rows, cols = create_table(key, cols)
-    text = list(cipher_text)
-    out_chars = []
-
-    for i in range(0, len(text), 2):
-        a = text[i]
-        b = text[i+1]
-        r1, c1 = pos[a]
-        r2, c2 = pos[b]
-        if r1 == r2:
-            da = table[r1][(c1 - 1) % cols]
-            db = table[r2][(c2 - 1) % cols]
-        elif c1 == c2:
-            da = table[(r1 - 1) % rows][c1]
-            db = table[(r2 - 1) % rows][c2]
-        else:
-            da = table[r1][c2]
-            db = table[r2][c1]
+    _, dec = pair_tables(key, cols)
+    plaintext = "".join(substitute(cipher_pairs(cipher_text), dec, "d", verbosity, trace))
 
-        out_chars.append(da)
-        out_chars.append(db)
+    if verbosity >= RESULT:
+        print(plaintext)
+    return plaintext
 
-        print(f"{a=} => {da=}")
-        print(f"{b=} => {db=}", end="\n\n")
+def write_pairs(pairs: Iterable[str], filename: str, batch: int = 8192):
+    """Write pairs to filename in batches."""
+    with open(filename, "w") as file:
+        out = []
+        for pair in pairs:
+            out.append(pair)
+            if len(out) >= batch:
+                file.write("".join(out))
+                out.clear()
+        file.write("".join(out))
+
+def encrypt_file(input_filename: str, output_filename: str, key: str, cols: int,
+                 chunk_size: int = CHUNK_SIZE, verbosity: int = SYMBOLS,
+                 trace: Optional[TraceWriter] = None):
+    """encrypt() over a file in constant memory: the same ciphertext as whole-file mode.
+
+    iter_bigrams pulls symbols across chunk edges itself and keeps any pending
+    doubled-letter rollback in its own buffer, so chunks are simply chained.
+    """
+    if len(key) % cols != 0:
+        print("Incorrect amount of symbols in key")
+        exit()
 
-    plaintext = "".join(out_chars)
+    enc, _ = pair_tables(key, cols)
+    symbols = chain.from_iterable(read_chunks(input_filename, chunk_size))
+    write_pairs(substitute(iter_bigrams(symbols, key), enc, "c", verbosity, trace), output_filename)
+    if verbosity >= RESULT:
+        print_file(output_filename, chunk_size)
 
-    print(plaintext)
-    return plaintext
+def decrypt_file(input_filename: str, output_filename: str, key: str, cols: int,
+                 chunk_size: int = CHUNK_SIZE, verbosity: int = SYMBOLS,
+                 trace: Optional[TraceWriter] = None):
+    if len(key) % cols != 0:
+        print("Incorrect amount of symbols in key")
+        exit()
+
+    _, dec = pair_tables(key, cols)
+    symbols = chain.from_iterable(read_chunks(input_filename, chunk_size))
+    write_pairs(substitute(cipher_pairs(symbols), dec, "d", verbosity, trace), output_filename)
+    if verbosity >= RESULT:
+        print_file(output_filename, chunk_size)
 
 def print_alphabet(key: str, cols: int):
     table, pos, rows, cols = create_table(key, cols)
@@ -177,6 +264,10 @@ def cipher_cli():
     parser.add_argument("--decrypt", type=str, help="decrypt filename")
     parser.add_argument("--output", type=str, help="output filename")
     parser.add_argument("--cols", type=int, help="amount of cols")
+    parser.add_argument("--verbosity", type=int, choices=[QUIET, RESULT, SYMBOLS], default=SYMBOLS,
+                        help="0: quiet, 1: print result, 2: print result and every substituted symbol")
+    parser.add_argument("--trace", type=str, help="write per-symbol trace to this file")
+    parser.add_argument("--chunk-size", type=int, help="stream the input in chunks of this many symbols")
     parser.add_argument("pkey", nargs="?", help="print key")
 
     args = parser.parse_args()
@@ -190,22 +281,30 @@ def cipher_cli():
         print_alphabet(key, args.cols)
     
     if args.encrypt:
-        plaintext = read_file(args.encrypt)
         key = read_file(args.key)
         cols = args.cols
         output_filename = args.output
 
-        cipher_text = encrypt(plaintext, key, cols)
-        write_file(cipher_text, output_filename)
+        with TraceWriter(args.trace) if args.trace else contextlib.nullcontext() as trace:
+            if args.chunk_size:
+                encrypt_file(args.encrypt, output_filename, key, cols, args.chunk_size, args.verbosity, trace)
+            else:
+                plaintext = read_file(args.encrypt)
+                cipher_text = encrypt(plaintext, key, cols, args.verbosity, trace)
+                write_file(cipher_text, output_filename)
 
     elif args.decrypt:
-        encrypted_text = read_file(args.decrypt)
         key = read_file(args.key)
         cols = args.cols
         output_filename = args.output
 
-        decrypted_text = decrypt(encrypted_text, key, cols)
-        write_file(decrypted_text, output_filename)
+        with TraceWriter(args.trace) if args.trace else contextlib.nullcontext() as trace:
+            if args.chunk_size:
+                decrypt_file(args.decrypt, output_filename, key, cols, args.chunk_size, args.verbosity, trace)
+            else:
+                encrypted_text = read_file(args.decrypt)
+                decrypted_text = decrypt(encrypted_text, key, cols, args.verbosity, trace)
+                write_file(decrypted_text, output_filename)
       
     return
 
@@ -1,41 +1,90 @@
 import argparse
+import contextlib
+import functools
+from typing import Optional, Tuple
+
+from trace_io import CHUNK_SIZE, QUIET, RESULT, SYMBOLS, TraceWriter, print_file, read_chunks
+
+def report(src: str, dst: str, verbosity: int, trace: Optional[TraceWriter], result: bool = True):
+    if trace is not None:
+        trace.write(src, dst)
+    if verbosity >= SYMBOLS:
+        print("\n".join(f"{a!r} => {b!r}" for a, b in zip(src, dst)))
+    if verbosity >= RESULT and result:
+        print(dst)
+
+class Substitution(dict):
+    """str.translate table that rejects symbols outside the key while translating."""
+    def __missing__(self, code):
+        raise ValueError(f"Symbol '{chr(code)}' not in key")
+
+@functools.lru_cache(maxsize=None)
+def substitution_tables(key: str, cols: int) -> Tuple[Substitution, Substitution]:
+    """Shift-by-cols translate tables (encrypt, decrypt); a repeated symbol uses its first position."""
+    n = len(key)
+    enc = Substitution()
+    dec = Substitution()
+    for pos in reversed(range(n)):
+        enc[ord(key[pos])] = key[(pos + cols) % n]
+        dec[ord(key[pos])] = key[(pos - cols) % n]
+    return enc, dec
 
 # polybian_square --key key.txt --encrypt plaintext.txt --output encrypted.txt
 # polybian_square --key key.txt --decrypt encrypted.txt --output decrypted.txt
 
 #ALPHABET = "ЩС0УФ8ЪЖГ.4ПЯ Р9ЛЗВ,Ь:3ЧШТЁЭ1ОЙД5ЫИ6-НКАБМ2ЦЕЮ7Х"
 
-def encrypt(plaintext: str, key: str, cols: int):
+def encrypt(plaintext: str, key: str, cols: int, verbosity: int = RESULT,
+            trace: Optional[TraceWriter] = None):
 
     if len(key) % cols != 0:
         print("Incorrect amount of symbols in key")
 
-    encrypted_text = ""
+    encrypted_text = plaintext.translate(substitution_tables(key, cols)[0])
 
-    for character in plaintext:
-        if character not in key:
-            raise ValueError(f"Symbol '{character}' not in key")
-        pos = key.find(character)
-        encrypted_text += key[(pos+cols)%len(key)]
-
-    print(*encrypted_text, sep="")
+    report(plaintext, encrypted_text, verbosity, trace)
     return encrypted_text
 
 
-def decrypt(encrypted_text: str, key: str, cols: int):
+def decrypt(encrypted_text: str, key: str, cols: int, verbosity: int = RESULT,
+            trace: Optional[TraceWriter] = None):
 
     if len(key) % cols != 0:
         print("Incorrect amount of symbols in key")
 
-    decrypted_text = ""
-   
-    for character in encrypted_text:
-        pos = key.find(character)
-        decrypted_text += key[(pos-cols)%len(key)]
+    decrypted_text = encrypted_text.translate(substitution_tables(key, cols)[1])
 
-    print(*decrypted_text, sep="")
+    report(encrypted_text, decrypted_text, verbosity, trace)
     return decrypted_text
 
+def translate_file(input_filename: str, output_filename: str, table: Substitution,
+                   chunk_size: int = CHUNK_SIZE, verbosity: int = RESULT,
+                   trace: Optional[TraceWriter] = None):
+    """Translate a file chunk by chunk; like read_file, trailing newlines are dropped."""
+    with open(output_filename, "w") as fout:
+        for text in read_chunks(input_filename, chunk_size):
+            out = text.translate(table)
+            fout.write(out)
+            report(text, out, verbosity, trace, result=False)
+    if verbosity >= RESULT:
+        print_file(output_filename, chunk_size)
+
+def encrypt_file(input_filename: str, output_filename: str, key: str, cols: int,
+                 chunk_size: int = CHUNK_SIZE, verbosity: int = RESULT,
+                 trace: Optional[TraceWriter] = None):
+    if len(key) % cols != 0:
+        print("Incorrect amount of symbols in key")
+    translate_file(input_filename, output_filename, substitution_tables(key, cols)[0],
+                   chunk_size, verbosity, trace)
+
+def decrypt_file(input_filename: str, output_filename: str, key: str, cols: int,
+                 chunk_size: int = CHUNK_SIZE, verbosity: int = RESULT,
+                 trace: Optional[TraceWriter] = None):
+    if len(key) % cols != 0:
+        print("Incorrect amount of symbols in key")
+    translate_file(input_filename, output_filename, substitution_tables(key, cols)[1],
+                   chunk_size, verbosity, trace)
+
 def print_alphabet(key: str, cols: int):
     i = 0
     for character in key:
@@ -62,6 +111,9 @@ def cipher_cli():
     parser.add_argument("--decrypt", type=str)
     parser.add_argument("--output", type=str)
     parser.add_argument("--cols", type=int)
+    parser.add_argument("--verbosity", type=int, choices=[QUIET, RESULT, SYMBOLS], default=RESULT)
+    parser.add_argument("--trace", type=str)
+    parser.add_argument("--chunk-size", type=int)
     parser.add_argument("pkey", nargs="?")
 
     args = parser.parse_args()
@@ -75,22 +127,30 @@ def cipher_cli():
         print_alphabet(key, args.cols)
     
     if args.encrypt:
-        plaintext = read_file(args.encrypt)
         key = read_file(args.key)
         cols = args.cols
         output_filename = args.output
 
-        cipher_text = encrypt(plaintext, key, cols)
-        write_file(cipher_text, output_filename)
+        with TraceWriter(args.trace) if args.trace else contextlib.nullcontext() as trace:
+            if args.chunk_size:
+                encrypt_file(args.encrypt, output_filename, key, cols, args.chunk_size, args.verbosity, trace)
+            else:
+                plaintext = read_file(args.encrypt)
+                cipher_text = encrypt(plaintext, key, cols, args.verbosity, trace)
+                write_file(cipher_text, output_filename)
 
     elif args.decrypt:
-        encrypted_text = read_file(args.decrypt)
         key = read_file(args.key)
         cols = args.cols
         output_filename = args.output
 
-        decrypted_text = decrypt(encrypted_text, key, cols)
-        write_file(decrypted_text, output_filename)
+        with TraceWriter(args.trace) if args.trace else contextlib.nullcontext() as trace:
+            if args.chunk_size:
+                decrypt_file(args.decrypt, output_filename, key, cols, args.chunk_size, args.verbosity, trace)
+            else:
+                encrypted_text = read_file(args.decrypt)
+                decrypted_text = decrypt(encrypted_text, key, cols, args.verbosity, trace)
+                write_file(decrypted_text, output_filename)
       
     return
 
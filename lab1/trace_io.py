@@ -0,0 +1,60 @@
+"""Verbosity levels, trace file and chunked file I/O shared by the lab1 ciphers."""
+
+from typing import Iterator
+
+CHUNK_SIZE = 1 << 20
+
+QUIET = 0     # nothing on stdout
+RESULT = 1    # only the resulting text
+SYMBOLS = 2   # result and every substituted symbol
+
+class TraceWriter:
+    """Per-symbol trace file ("source<TAB>substitute" lines), flushed every `batch` lines."""
+
+    def __init__(self, filename: str, batch: int = 8192):
+        self.file = open(filename, "w")
+        self.batch = batch
+        self.lines = []
+
+    def write(self, src: str, dst: str):
+        for a, b in zip(src, dst):
+            self.lines.append(f"{a}\t{b}\n")
+            if len(self.lines) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.lines))
+        self.lines.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_chunks(filename: str, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """The file in chunk_size pieces; like read_file, trailing newlines are dropped."""
+    newlines = ""
+    with open(filename, "r") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            # trailing newlines are held back until we know whether the file ends there
+            chunk = newlines + chunk
+            text = chunk.rstrip("\n")
+            newlines = chunk[len(text):]
+            if text:
+                yield text
+
+def print_file(filename: str, chunk_size: int = CHUNK_SIZE):
+    """Echo a written result file; done after the whole file so the per-symbol
+    trace comes first, as in whole-file mode."""
+    with open(filename, "r") as file:
+        for chunk in iter(lambda: file.read(chunk_size), ""):
+            print(chunk, end="")
+    print()
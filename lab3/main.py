@@ -1,9 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from itertools import permutations
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import argparse
-from typing import List, Tuple, Set
+import bisect
+import functools
+import heapq
+import math
+import random
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy нужен только для n-граммной оценки (--score ngram)
+    np = None
 
 RUS_LETTERS = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
 ALPHABET = RUS_LETTERS + " " + "."
@@ -27,9 +39,54 @@ def write_file(path: str, text: str):
     with open(path, "w", encoding="utf-8") as f:
         f.write(text)
 
+FILE_CHUNK_CHARS = 1 << 22
+
+class _DropMissing(dict):
+    """Таблица для str.translate: символы, которых в ней нет, удаляются."""
+    def __missing__(self, key):
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _upper_sources(alphabet: str) -> Dict[int, str]:
+    """Кодовая точка -> буква алфавита, которой она становится после upper().
+       Просматривается вся BMP (и дальше, если в алфавите есть символы за её пределами):
+       кроме строчных букв туда попадают, например, варианты кириллицы U+1C80..U+1C86."""
+    limit = max(0x10000, max(ord(ch) for ch in alphabet) + 1)
+    letters = set(alphabet)
+    return {c: up for c in range(limit) if (up := chr(c).upper()) in letters}
+
+@functools.lru_cache(maxsize=None)
+def _normalize_table(alphabet: str) -> Dict[int, Optional[int]]:
+    """Кодовая точка -> кодовая точка прописной буквы алфавита (None — удалить).
+       Явно покрывает все кодовые точки до последней, переходящей в алфавит; остальные удаляет __missing__."""
+    sources = _upper_sources(alphabet)
+    table = _DropMissing()
+    for c in range(max(sources) + 1):
+        table[c] = ord(sources[c]) if c in sources else None
+    return table
+
+@functools.lru_cache(maxsize=None)
+def _normalize_lut(alphabet: str) -> "np.ndarray":
+    """То же, что _normalize_table, массивом для NumPy: кодовая точка -> индекс в алфавите (255 — удалить)."""
+    sources = _upper_sources(alphabet)
+    lut = np.full(max(sources) + 1, 255, dtype=np.uint8)
+    for c, up in sources.items():
+        lut[c] = alphabet.index(up)
+    return lut
+
 def normalize_text(s: str, alphabet: str) -> str:
-    s_up = s.upper()
-    return "".join(ch for ch in s_up if ch in alphabet)
+    return s.translate(_normalize_table(alphabet))
+
+def canonical_key(key: str, alphabet: str) -> str:
+    """Ключ без повторов и посторонних символов: таблица Трисемуса определяется только им,
+       поэтому ключи с одинаковым canonical_key дают одну и ту же подстановку."""
+    seen = set()
+    seq = []
+    for ch in key.upper():
+        if ch in alphabet and ch not in seen:
+            seq.append(ch)
+            seen.add(ch)
+    return "".join(seq)
 
 class Trisemus:
     def __init__(self, alphabet: str, key: str, rows: int):
@@ -45,43 +102,95 @@ class Trisemus:
         for idx, ch in enumerate(self.table):
             if ch not in self.pos:
                 self.pos[ch] = idx
+        # таблицы для str.translate / NumPy, заполняются лениво (см. _translate_table)
+        self._tables = {}
 
     def _build_table(self, key: str) -> List[str]:
-        seen = set()
-        seq = []
-        for ch in key.upper():
-            if ch in self.alphabet and ch not in seen:
-                seq.append(ch)
-                seen.add(ch)
+        seq = list(canonical_key(key, self.alphabet))
+        seen = set(seq)
         for ch in self.alphabet:
             if ch not in seen:
                 seq.append(ch)
                 seen.add(ch)
         return seq
 
+    # Таблицы для str.translate строятся лениво: анализ создаёт Trisemus на каждого
+    # кандидата, а шифрует текстом лишь победителей.
+    # "enc"/"dec" — только подстановка, "enc_raw"/"dec_raw" — ещё и нормализация.
+    def _translate_table(self, kind: str):
+        tables = self._tables
+        if kind not in tables:
+            mapping = self.encrypt_map() if kind.startswith("enc") else self.decrypt_map()
+            if kind.endswith("_raw"):
+                tables[kind] = _DropMissing({c: (None if up is None else ord(mapping[chr(up)]))
+                                             for c, up in _normalize_table(self.alphabet).items()})
+            else:
+                tables[kind] = str.maketrans(mapping)
+        return tables[kind]
+
+    def _translate_raw(self, kind: str, text: str) -> str:
+        if np is None:
+            return text.translate(self._translate_table(kind))
+        # с NumPy: индексы нормализованного текста -> кодовые точки результата одной выборкой
+        tables = self._tables
+        key = kind + "_np"
+        if key not in tables:
+            mapping = self.encrypt_map() if kind.startswith("enc") else self.decrypt_map()
+            tables[key] = np.array([ord(mapping[ch]) for ch in self.alphabet], dtype=np.uint32)
+        idx = _normalized_indices(text, _normalize_lut(self.alphabet))
+        return tables[key][idx].tobytes().decode("utf-32-le")
+
+    def _check(self, text: str):
+        if not self.pos.keys() >= set(text):
+            ch = next(ch for ch in text if ch not in self.pos)
+            raise ValueError(f"Символ '{ch}' не в алфавите.")
+
     def encrypt(self, plaintext: str) -> str:
-        out = []
-        for ch in plaintext:
-            if ch not in self.pos:
-                raise ValueError(f"Символ '{ch}' не в алфавите.")
-            idx = self.pos[ch]
-            r, c = divmod(idx, self.cols)
-            r2 = (r + 1) % self.rows  
-            idx2 = r2 * self.cols + c
-            out.append(self.table[idx2])
-        return "".join(out)
+        self._check(plaintext)
+        return plaintext.translate(self._translate_table("enc"))
 
     def decrypt(self, ciphertext: str) -> str:
-        out = []
-        for ch in ciphertext:
-            if ch not in self.pos:
-                raise ValueError(f"Символ '{ch}' не в алфавите.")
-            idx = self.pos[ch]
-            r, c = divmod(idx, self.cols)
-            r2 = (r - 1) % self.rows
-            idx2 = r2 * self.cols + c
-            out.append(self.table[idx2])
-        return "".join(out)
+        self._check(ciphertext)
+        return ciphertext.translate(self._translate_table("dec"))
+
+    def encrypt_raw(self, text: str) -> str:
+        """encrypt(normalize_text(text)) за один проход."""
+        return self._translate_raw("enc_raw", text)
+
+    def decrypt_raw(self, text: str) -> str:
+        """decrypt(normalize_text(text)) за один проход."""
+        return self._translate_raw("dec_raw", text)
+
+    def _process_file(self, kind: str, in_path: str, out_path: str, chunk_chars: int) -> int:
+        # подстановка посимвольная, поэтому куски обрабатываются независимо
+        total = 0
+        with open(in_path, "r", encoding="utf-8") as fin, open(out_path, "w", encoding="utf-8") as fout:
+            while True:
+                chunk = fin.read(chunk_chars)
+                if not chunk:
+                    break
+                out = self._translate_raw(kind, chunk)
+                fout.write(out)
+                total += len(out)
+        return total
+
+    def encrypt_file(self, in_path: str, out_path: str, chunk_chars: int = FILE_CHUNK_CHARS) -> int:
+        """Нормализовать и зашифровать файл кусками; возвращает число записанных символов."""
+        return self._process_file("enc_raw", in_path, out_path, chunk_chars)
+
+    def decrypt_file(self, in_path: str, out_path: str, chunk_chars: int = FILE_CHUNK_CHARS) -> int:
+        """Нормализовать и расшифровать файл кусками; возвращает число записанных символов."""
+        return self._process_file("dec_raw", in_path, out_path, chunk_chars)
+
+    def encrypt_map(self) -> Dict[str, str]:
+        """Подстановка символ открытого текста -> символ шифртекста (сдвиг на строку вниз)."""
+        n = len(self.table)
+        return {ch: self.table[(idx + self.cols) % n] for ch, idx in self.pos.items()}
+
+    def decrypt_map(self) -> Dict[str, str]:
+        """Подстановка символ шифртекста -> символ открытого текста (сдвиг на строку вверх)."""
+        n = len(self.table)
+        return {ch: self.table[(idx - self.cols) % n] for ch, idx in self.pos.items()}
 
     def print_table(self):
         for r in range(self.rows):
@@ -98,6 +207,12 @@ def compute_W(text: str, alphabet: str) -> float:
     for ch in text:
         if ch in counts:
             counts[ch] += 1
+    return compute_W_from_counts(counts, N, alphabet)
+
+def compute_W_from_counts(counts: Dict[str, int], N: int, alphabet: str) -> float:
+    """W по гистограмме символов текста длины N (counts[ch] — число вхождений ch)."""
+    if N == 0:
+        return float('inf')
     W = 0.0
     for ch in alphabet:
         Pobs = counts[ch] / N
@@ -107,103 +222,735 @@ def compute_W(text: str, alphabet: str) -> float:
         W += (Pobs - Ptab) ** 2
     return W
 
-def analyze_trisemus_permutations(ciphertext: str, rows: int,
-                                  perm_chars: str,
-                                  alphabet: str,
-                                  key_template: str = None,
-                                  top_n: int = 10) -> List[Tuple[float, str, str]]:
-    ciphertext = normalize_text(ciphertext, alphabet)
-    results: List[Tuple[float, str, str]] = []
-    seen: Set[Tuple[str, ...]] = set()
+# ------------------ n-граммная модель ------------------
+# Текст хранится массивом индексов символов в алфавите, модель — массивом условных
+# log P(c_k | предыдущие order-1 символов) формы (n,) * order. Оценка текста — одна
+# векторная выборка из этого массива по сдвинутым срезам индексов.
 
-    if key_template:
-        if key_template.count('?') != len(perm_chars):
-            raise ValueError("Число '?' в key_template должно совпадать с длиной perm_chars")
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("Для n-граммной модели нужен NumPy (pip install numpy)")
 
-    permutations_list = set(permutations(perm_chars))
-    for perm in permutations_list:
-        if perm in seen:
-            continue
-        seen.add(perm)
-
-        if key_template:
-            filled = list(key_template.upper())
-            idx = 0
-            for i, ch in enumerate(filled):
-                if ch == '?':
-                    filled[i] = perm[idx]
-                    idx += 1
-            candidate_key = "".join(filled)
-        else:
-            candidate_key = "".join(perm)
+def text_to_indices(text: str, alphabet: str) -> "np.ndarray":
+    """Индексы символов text в alphabet (символы вне алфавита пропускаются)."""
+    _require_numpy()
+    pos = {ch: i for i, ch in enumerate(alphabet)}
+    return np.fromiter((pos[ch] for ch in text if ch in pos), dtype=np.uint8)
+
+# Корпус читается потоком: каждый кусок нормализуется таблицей кодовая точка -> индекс
+# (строчные и прописные буквы ведут в один индекс, прочие символы отбрасываются — та же
+# семантика, что у normalize_text), последние два символа переносятся в следующий кусок.
+# Счётчики уни-, би- и триграмм лежат подряд в одном плоском массиве int64: файл модели —
+# этот массив в .npy, он отображается в память при загрузке.
+
+CORPUS_CHUNK_CHARS = 1 << 22
+
+def _normalized_indices(text: str, lut: "np.ndarray") -> "np.ndarray":
+    """Индексы normalize_text(text) без сборки промежуточной строки."""
+    cps = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    idx = lut[np.minimum(cps, len(lut) - 1)]
+    # кодовые точки за пределами таблицы попали на её последний элемент — отбрасываем их
+    return idx[(idx != 255) & (cps < len(lut))]
+
+def _ngram_bincount(idx: "np.ndarray", n: int, order: int) -> "np.ndarray":
+    m = len(idx) - order + 1
+    if m <= 0:
+        return np.zeros(n ** order, dtype=np.int64)
+    flat = np.zeros(m, dtype=np.int64)
+    for k in range(order):
+        flat = flat * n + idx[k:k + m]
+    return np.bincount(flat, minlength=n ** order)
+
+def ngram_counts_layout(n: int) -> List[Tuple[int, int]]:
+    """Срезы [start, stop) уни-, би- и триграмм в плоском массиве счётчиков."""
+    sizes = [n, n * n, n * n * n]
+    return [(sum(sizes[:k]), sum(sizes[:k + 1])) for k in range(3)]
+
+def count_corpus_file(path: str, alphabet: str = ALPHABET, chunk_chars: int = CORPUS_CHUNK_CHARS) -> "np.ndarray":
+    """Плоский массив счётчиков n-грамм файла path; память O(chunk_chars)."""
+    _require_numpy()
+    n = len(alphabet)
+    lut = _normalize_lut(alphabet)
+    counts = np.zeros(ngram_counts_layout(n)[-1][1], dtype=np.int64)
+    tail = np.zeros(0, dtype=np.int64)
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        while True:
+            chunk = f.read(chunk_chars)
+            if not chunk:
+                break
+            new = _normalized_indices(chunk, lut).astype(np.int64)
+            idx = np.concatenate([tail, new])
+            for order, (start, stop) in enumerate(ngram_counts_layout(n), 1):
+                # n-граммы, целиком лежащие в перенесённом хвосте, уже посчитаны
+                skip = max(len(tail) - order + 1, 0)
+                counts[start:stop] += _ngram_bincount(idx[skip:], n, order)
+            tail = idx[-2:]
+    return counts
+
+def _count_corpus_job(job) -> "np.ndarray":
+    return count_corpus_file(*job)
+
+def build_ngram_counts(paths: List[str], alphabet: str = ALPHABET, workers: int = 1) -> "np.ndarray":
+    """Сумма счётчиков по файлам-шардам корпуса; при workers > 1 файлы считаются в разных процессах."""
+    _require_numpy()
+    jobs = [(path, alphabet) for path in paths]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            parts = list(ex.map(_count_corpus_job, jobs))
+    else:
+        parts = [_count_corpus_job(job) for job in jobs]
+    return np.sum(parts, axis=0, dtype=np.int64)
+
+def save_ngram_counts(path: str, counts: "np.ndarray"):
+    with open(path, "wb") as f:
+        np.save(f, np.ascontiguousarray(counts, dtype=np.int64))
+
+class NgramModel:
+    def __init__(self, logp: "np.ndarray", alphabet: str = ALPHABET):
+        _require_numpy()
+        n = len(alphabet)
+        if logp.ndim not in (2, 3) or any(d != n for d in logp.shape):
+            raise ValueError(f"Ожидался массив формы ({n}, {n}) или ({n}, {n}, {n}), получен {logp.shape}")
+        self.alphabet = alphabet
+        self.order = logp.ndim
+        self.logp = logp
+        self._pos = {ch: i for i, ch in enumerate(alphabet)}
+
+    @classmethod
+    def from_counts(cls, counts: "np.ndarray", order: int = 3, alphabet: str = ALPHABET,
+                    smoothing: float = 0.5) -> "NgramModel":
+        """Модель по плоскому массиву счётчиков (см. ngram_counts_layout), сглаживание add-k."""
+        _require_numpy()
+        if order not in (2, 3):
+            raise ValueError("Поддерживаются только биграммы и триграммы (order 2 или 3)")
+        n = len(alphabet)
+        start, stop = ngram_counts_layout(n)[order - 1]
+        grams = np.asarray(counts[start:stop], dtype=np.float64).reshape((n,) * order) + smoothing
+        logp = np.log(grams / grams.sum(axis=-1, keepdims=True)).astype(np.float32)
+        return cls(logp, alphabet)
+
+    @classmethod
+    def train(cls, text: str, order: int = 3, alphabet: str = ALPHABET, smoothing: float = 0.5) -> "NgramModel":
+        """Модель по корпусу text (нормализуется по alphabet), сглаживание add-k."""
+        _require_numpy()
+        n = len(alphabet)
+        idx = _normalized_indices(text, _normalize_lut(alphabet)).astype(np.int64)
+        counts = np.concatenate([_ngram_bincount(idx, n, k) for k in (1, 2, 3)])
+        return cls.from_counts(counts, order, alphabet, smoothing)
+
+    @classmethod
+    def load(cls, path: str, order: int = 3, alphabet: str = ALPHABET) -> "NgramModel":
+        """Файл build-model (плоские счётчики) или сохранённый save() массив log P."""
+        _require_numpy()
+        arr = np.load(path, mmap_mode="r")
+        if arr.ndim == 1:
+            return cls.from_counts(arr, order, alphabet)
+        return cls(arr, alphabet)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.save(f, np.ascontiguousarray(self.logp, dtype=np.float32))
+
+    def score(self, idx: "np.ndarray") -> float:
+        """Средний -log P на символ (меньше — правдоподобнее), как и W."""
+        if len(idx) < self.order:
+            return float('inf')
+        m = len(idx) - self.order + 1
+        return -float(self.logp[tuple(idx[k:k + m] for k in range(self.order))].sum(dtype=np.float64)) / m
+
+    def score_mapping(self, mapping: Dict[str, str], ct_idx: "np.ndarray") -> float:
+        """Оценка открытого текста, полученного из ct_idx подстановкой mapping, без сборки строки."""
+        perm = np.array([self._pos[mapping[ch]] for ch in self.alphabet], dtype=np.uint8)
+        return self.score(perm[ct_idx])
+
+# ------------------ перестановки мультимножества ------------------
+# Различные перестановки perm_chars нумеруются в лексикографическом порядке;
+# по номеру (unrank) можно сразу встать в любую точку и дальше идти next_permutation,
+# поэтому диапазон номеров перебирается без перечисления всего множества.
+
+def _multinomial(counts: Iterable[int]) -> int:
+    counts = list(counts)
+    total = math.factorial(sum(counts))
+    for m in counts:
+        total //= math.factorial(m)
+    return total
+
+def count_permutations(chars: str) -> int:
+    """Число различных перестановок символов chars (с учётом повторов)."""
+    return _multinomial(Counter(chars).values())
 
+def unrank_permutation(chars: str, index: int) -> List[str]:
+    """Перестановка chars с номером index (с 0) в лексикографическом порядке различных перестановок."""
+    remaining = Counter(chars)
+    out = []
+    for _ in range(len(chars)):
+        for ch in sorted(remaining):
+            if not remaining[ch]:
+                continue
+            remaining[ch] -= 1
+            block = _multinomial(remaining.values())  # перестановок с префиксом out + ch
+            if index < block:
+                out.append(ch)
+                break
+            index -= block
+            remaining[ch] += 1
+    return out
+
+def next_permutation(seq: List[str]) -> bool:
+    """Следующая в лексикографическом порядке перестановка (на месте); False — если seq была последней."""
+    i = len(seq) - 2
+    while i >= 0 and seq[i] >= seq[i + 1]:
+        i -= 1
+    if i < 0:
+        return False
+    j = len(seq) - 1
+    while seq[j] <= seq[i]:
+        j -= 1
+    seq[i], seq[j] = seq[j], seq[i]
+    seq[i + 1:] = reversed(seq[i + 1:])
+    return True
+
+def iter_permutations(chars: str, start: int, stop: int) -> Iterator[Tuple[str, ...]]:
+    """Перестановки с номерами start..stop-1."""
+    if start >= stop:
+        return
+    perm = unrank_permutation(chars, start)
+    for _ in range(stop - start):
+        yield tuple(perm)
+        next_permutation(perm)
+
+# ------------------ анализ ------------------
+def fill_key_template(key_template: Optional[str], perm) -> str:
+    """Подставить символы perm вместо '?' шаблона (без шаблона ключ — сама перестановка)."""
+    if not key_template:
+        return "".join(perm)
+    filled = list(key_template.upper())
+    idx = 0
+    for i, ch in enumerate(filled):
+        if ch == '?':
+            filled[i] = perm[idx]
+            idx += 1
+    return "".join(filled)
+
+def _drops_chars(key: str, canon: str) -> bool:
+    """Отбросил ли canonical_key символы ключа (повторы или символы вне алфавита). Все ключи
+       одного перебора составлены из одного и того же набора символов, поэтому если ничего не
+       отброшено, разные перестановки дают разные таблицы и множество уже оценённых не нужно."""
+    return len(canon) < len(key.upper())
+
+def _score_permutations(perms: Iterable[Tuple[str, ...]], ct_counts: Dict[str, int], N: int,
+                        rows: int, alphabet: str, key_template: Optional[str],
+                        stats: Optional[Counter] = None,
+                        model: Optional[NgramModel] = None,
+                        ct_idx: Optional["np.ndarray"] = None) -> Iterator[Tuple[float, str]]:
+    """(оценка, ключ) для каждой различной таблицы; невалидные ключи и ключи, дающие уже
+       оценённую таблицу, пропускаются (stats["hits"] / stats["misses"]).
+       Оценка — W по гистограмме или, если задана model, её score по индексам шифртекста ct_idx."""
+    if stats is None:
+        stats = Counter()
+    scored = set()
+    for perm in perms:
+        candidate_key = fill_key_template(key_template, perm)
+        canon = canonical_key(candidate_key, alphabet)
+        if _drops_chars(candidate_key, canon):
+            if canon in scored:
+                stats["hits"] += 1
+                continue
+            scored.add(canon)
+        stats["misses"] += 1
         try:
             tr = Trisemus(alphabet=alphabet, key=candidate_key, rows=rows)
-            pt = tr.decrypt(ciphertext)
         except Exception:
             continue
+        if model is not None:
+            yield model.score_mapping(tr.decrypt_map(), ct_idx), candidate_key
+            continue
+        enc = tr.encrypt_map()
+        yield compute_W_from_counts({ch: ct_counts[enc[ch]] for ch in alphabet}, N, alphabet), candidate_key
+
+def _score_shard(job) -> Tuple[List[Tuple[float, str]], Counter]:
+    """Задача процесса: свой top_n-heap по диапазону номеров перестановок [start, stop)."""
+    perm_chars, start, stop, ct_counts, N, rows, alphabet, key_template, top_n, model, ct_idx = job
+    perms = iter_permutations(perm_chars, start, stop)
+    stats: Counter = Counter()
+    top = heapq.nsmallest(top_n, _score_permutations(perms, ct_counts, N, rows, alphabet, key_template, stats,
+                                                     model, ct_idx))
+    return top, stats
+
+# ------------------ ветви и границы ------------------
+# Множество символов ключа K известно заранее (фиксированные символы шаблона + perm_chars),
+# поэтому хвост таблицы — алфавит без K по порядку — фиксирован с самого начала, а префикс
+# ключа фиксирует ещё и первые позиции. Символ открытого текста на позиции i шифруется
+# символом на позиции (i + cols) mod n: пары с обеими известными позициями дают точный вклад
+# в W. Оставшиеся символы открытого текста и шифртекста сопоставляются оптимально без
+# учёта структуры таблицы (ослабление), так что оценка не превышает W ни одного ключа
+# из поддерева.
+
+def _min_matching_sq(pt_freqs: List[float], ct_freqs: List[float]) -> float:
+    """min по биекциям суммы (Ptab - Pobs)^2, слагаемые с Ptab == 0 не считаются.
+       При квадратичной стоимости оптимальное сопоставление монотонно, поэтому ненулевые
+       Ptab сопоставляются по порядку с подпоследовательностью Pobs; пропускаемые Pobs
+       достаются символам с Ptab == 0 (их k штук)."""
+    a = sorted(p for p in pt_freqs if p != 0.0)
+    b = sorted(ct_freqs)
+    k = len(b) - len(a)
+    # dp[s] — стоимость для обработанного префикса a, если пропущено s элементов b
+    dp = [0.0] * (k + 1)
+    for i, p in enumerate(a):
+        new = [0.0] * (k + 1)
+        best = float('inf')
+        for s in range(k + 1):
+            best = min(best, dp[s])
+            new[s] = best + (b[i + s] - p) ** 2
+        dp = new
+    return min(dp)
+
+def _lower_bound_W(prefix: str, key_len: int, tail: str, ct_counts: Dict[str, int], N: int,
+                   cols: int, alphabet: str) -> float:
+    """Нижняя оценка W для всех ключей, таблица которых начинается с prefix (canonical_key);
+       key_len — число различных символов ключа, tail — хвост таблицы после них."""
+    n = len(alphabet)
+    table: List[Optional[str]] = list(prefix) + [None] * (key_len - len(prefix)) + list(tail)
+    unknown = set(alphabet) - set(prefix) - set(tail)
+    W = 0.0
+    pt_pool = [RUS_FREQ_TABLE.get(ch, 0.0) for ch in unknown]
+    ct_pool = [ct_counts[ch] / N for ch in unknown]
+    for i in range(n):
+        pt_ch, ct_ch = table[i], table[(i + cols) % n]
+        if pt_ch is not None and ct_ch is not None:
+            Ptab = RUS_FREQ_TABLE.get(pt_ch, 0.0)
+            if Ptab != 0.0:
+                W += (ct_counts[ct_ch] / N - Ptab) ** 2
+            continue
+        if pt_ch is not None:
+            pt_pool.append(RUS_FREQ_TABLE.get(pt_ch, 0.0))
+        if ct_ch is not None:
+            ct_pool.append(ct_counts[ct_ch] / N)
+    return W + _min_matching_sq(pt_pool, ct_pool)
+
+def _branch_and_bound(perm_chars: str, ct_counts: Dict[str, int], N: int, rows: int, alphabet: str,
+                      key_template: Optional[str], top_n: int,
+                      stats: Optional[Counter] = None) -> List[Tuple[float, str]]:
+    """Тот же top_n, что и у полного перебора, но поиском в глубину по частичным
+       подстановкам с отсечением поддеревьев, оценка которых хуже текущего top_n-го W.
+       В stats добавляются nodes (посещённые узлы) и pruned (отсечённые поддеревья)."""
+    if stats is None:
+        stats = Counter()
+    n = len(alphabet)
+    if n % rows != 0:
+        return []
+    cols = n // rows
+    filled = list(key_template.upper()) if key_template else ['?'] * len(perm_chars)
+    slots = [i for i, ch in enumerate(filled) if ch == '?']
+    key_chars = set(canonical_key("".join(filled).replace('?', '') + perm_chars, alphabet))
+    tail = "".join(ch for ch in alphabet if ch not in key_chars)
+    remaining = Counter(perm_chars)
+    best: List[Tuple[float, str]] = []
+    scored = set()
+
+    def worst() -> float:
+        # допуск на округление: оценка и точный W суммируют одни и те же слагаемые в разном порядке
+        return best[-1][0] * (1 + 1e-9) if len(best) == top_n else float('inf')
 
-        W = compute_W(pt, alphabet)
-        results.append((W, candidate_key, pt))
+    def dfs(depth: int):
+        stats["nodes"] += 1
+        if depth == len(slots):
+            key = "".join(filled)
+            canon = canonical_key(key, alphabet)
+            if _drops_chars(key, canon):
+                if canon in scored:
+                    stats["hits"] += 1
+                    return
+                scored.add(canon)
+            stats["misses"] += 1
+            enc = Trisemus(alphabet=alphabet, key=key, rows=rows).encrypt_map()
+            bisect.insort(best, (compute_W_from_counts({ch: ct_counts[enc[ch]] for ch in alphabet}, N, alphabet), key))
+            del best[top_n:]
+            return
+        pos = slots[depth]
+        # префикс ключа известен до следующего '?' (на последнем уровне — весь ключ)
+        stop = slots[depth + 1] if depth + 1 < len(slots) else len(filled)
+        for ch in sorted(remaining):
+            if not remaining[ch]:
+                continue
+            remaining[ch] -= 1
+            filled[pos] = ch
+            prefix = canonical_key("".join(filled[:stop]), alphabet)
+            if _lower_bound_W(prefix, len(key_chars), tail, ct_counts, N, cols, alphabet) <= worst():
+                dfs(depth + 1)
+            else:
+                stats["pruned"] += 1
+            remaining[ch] += 1
+        filled[pos] = '?'
+
+    if top_n > 0:
+        dfs(0)
+    return best
+
+def _bnb_job(job) -> Tuple[List[Tuple[float, str]], Counter]:
+    perm_chars, ct_counts, N, rows, alphabet, key_template, top_n = job
+    stats: Counter = Counter()
+    return _branch_and_bound(perm_chars, ct_counts, N, rows, alphabet, key_template, top_n, stats), stats
+
+# ------------------ анализ нескольких конфигураций ------------------
+# Конфигурация — пара (rows, key_template). Шифртекст нормализуется и считается один раз,
+# задачи всех конфигураций (доли перестановок или целые bnb-поиски) идут в общий пул
+# процессов, а их top_n сливаются в один рейтинг.
+
+def analyze_trisemus_configs(ciphertext: str,
+                             configs: List[Tuple[int, Optional[str]]],
+                             perm_chars: str,
+                             alphabet: str,
+                             top_n: int = 10,
+                             workers: int = 1,
+                             stats: Optional[Counter] = None,
+                             search: str = "exhaustive",
+                             model: Optional[NgramModel] = None) -> List[Tuple[float, int, str, str]]:
+    """top_n четвёрок (оценка, rows, ключ, открытый текст) по всем конфигурациям сразу.
+       Параметры — как у analyze_trisemus_permutations."""
+    if search not in ("exhaustive", "bnb"):
+        raise ValueError(f"Неизвестный режим поиска: {search}")
+    if search == "bnb" and model is not None:
+        raise ValueError("Ветви и границы поддерживают только оценку W")
+    for _, key_template in configs:
+        if key_template and key_template.count('?') != len(perm_chars):
+            raise ValueError("Число '?' в key_template должно совпадать с длиной perm_chars")
+    if stats is None:
+        stats = Counter()
+
+    ciphertext = normalize_text(ciphertext, alphabet)
+    # Трисемус — моноалфавитная подстановка: гистограмма открытого текста — это
+    # гистограмма шифртекста, переставленная таблицей, поэтому шифртекст считаем один раз,
+    # а кандидат оцениваем за O(|alphabet|) без расшифрования.
+    N = len(ciphertext)
+    counts = Counter(ciphertext)
+    ct_counts = {ch: counts[ch] for ch in alphabet}
+    ct_idx = text_to_indices(ciphertext, alphabet) if model is not None else None
 
-    results.sort(key=lambda x: x[0])
-    return results[:top_n]
+    tasks = []  # (rows, функция, задача)
+    total = count_permutations(perm_chars)
+    # долей больше, чем процессов, — чтобы неравные по времени доли не простаивали
+    shards = 1 if workers <= 1 else max(1, min(total, workers * 8))
+    bounds = [total * i // shards for i in range(shards + 1)]
+    for rows, key_template in configs:
+        if search == "bnb":
+            tasks.append((rows, _bnb_job, (perm_chars, ct_counts, N, rows, alphabet, key_template, top_n)))
+            continue
+        for i in range(shards):
+            tasks.append((rows, _score_shard, (perm_chars, bounds[i], bounds[i + 1], ct_counts, N, rows, alphabet,
+                                               key_template, top_n, model, ct_idx)))
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = [(rows, ex.submit(fn, job)) for rows, fn, job in tasks]
+            parts = [(rows, f.result()) for rows, f in futures]
+    else:
+        parts = [(rows, fn(job)) for rows, fn, job in tasks]
+
+    candidates = []
+    for rows, (top, part_stats) in parts:
+        stats.update(part_stats)
+        candidates.extend((W, rows, k) for W, k in top)
+    # кэш таблиц у каждой задачи свой: одна и та же таблица может прийти из разных долей
+    # (и из разных шаблонов с одинаковым rows)
+    merged = []
+    seen = set()
+    for W, rows, k in sorted(candidates):
+        canon = (rows, canonical_key(k, alphabet))
+        if canon in seen:
+            continue
+        seen.add(canon)
+        merged.append((W, rows, k))
+        if len(merged) == top_n:
+            break
+    # открытый текст восстанавливается только для победителей
+    return [(W, rows, k, Trisemus(alphabet=alphabet, key=k, rows=rows).decrypt(ciphertext))
+            for W, rows, k in merged]
+
+def analyze_trisemus_permutations(ciphertext: str, rows: int,
+                                  perm_chars: str,
+                                  alphabet: str,
+                                  key_template: str = None,
+                                  top_n: int = 10,
+                                  workers: int = 1,
+                                  stats: Optional[Counter] = None,
+                                  search: str = "exhaustive",
+                                  model: Optional[NgramModel] = None) -> List[Tuple[float, str, str]]:
+    """Перебор перестановок perm_chars; при workers > 1 пространство перестановок делится
+       на диапазоны номеров между процессами, результаты сливаются по top_n.
+       Каждая различная таблица оценивается один раз; если передан stats, в него
+       добавляются hits (пропущенные повторные ключи) и misses (оценённые таблицы).
+       search="bnb" — ветви и границы (однопроцессный, workers игнорируется).
+       Если задана model, кандидаты ранжируются её n-граммной оценкой вместо W
+       (только полный перебор: нижняя оценка bnb выведена для W)."""
+    results = analyze_trisemus_configs(ciphertext, [(rows, key_template)], perm_chars, alphabet,
+                                       top_n, workers, stats, search, model)
+    return [(W, k, pt) for W, _, k, pt in results]
+
+# ------------------ отжиг ------------------
+# Для длинных ключей полный перебор недоступен: состояние — ключ без повторов, соседние
+# состояния получаются перестановкой двух букв (swap), вставкой новой буквы (insert,
+# при максимальной длине — заменой) и переносом буквы на другое место (shift). После мутации
+# пересчитываются только слагаемые W для позиций таблицы, которые изменились, и позиций,
+# шифрующихся в них.
+
+def _anneal_terms(table: List[str], obs: Dict[str, float], cols: int) -> List[float]:
+    n = len(table)
+    terms = []
+    for i, ch in enumerate(table):
+        Ptab = RUS_FREQ_TABLE.get(ch, 0.0)
+        terms.append(0.0 if Ptab == 0.0 else (obs[table[(i + cols) % n]] - Ptab) ** 2)
+    return terms
+
+def _mutate_key(key: List[str], alphabet: str, max_key_len: int, rng: random.Random) -> List[str]:
+    key = list(key)
+    free = [c for c in alphabet if c not in key]
+    move = rng.randrange(3)
+    if move == 1 and not free:
+        # все буквы алфавита уже в ключе — вставлять нечего, меняем местами
+        move = 0
+    if move == 0 and len(key) >= 2:
+        i, j = rng.sample(range(len(key)), 2)
+        key[i], key[j] = key[j], key[i]
+    elif (move == 1 or len(key) < 2) and free:
+        ch = rng.choice(free)
+        if len(key) >= max_key_len:
+            key.pop(rng.randrange(len(key)))
+        key.insert(rng.randrange(len(key) + 1), ch)
+    else:
+        ch = key.pop(rng.randrange(len(key)))
+        key.insert(rng.randrange(len(key) + 1), ch)
+    return key
+
+def _anneal_run(job) -> Tuple[float, str, int]:
+    """Один перезапуск отжига: (лучший W, ключ, число итераций)."""
+    (ct_counts, N, rows, alphabet, max_key_len, iters, time_budget, target,
+     t_start, t_end, seed) = job
+    rng = random.Random(seed)
+    n = len(alphabet)
+    cols = n // rows
+    obs = {ch: ct_counts[ch] / N for ch in alphabet}
+
+    def build(key: List[str]) -> List[str]:
+        return key + [ch for ch in alphabet if ch not in key]
+
+    key = rng.sample(alphabet, rng.randint(1, max_key_len))
+    table = build(key)
+    terms = _anneal_terms(table, obs, cols)
+    W = sum(terms)
+    best_W, best_key = W, "".join(key)
+    deadline = time.monotonic() + time_budget if time_budget else None
+    progress = 0.0
+    it = 0
+    while it < iters:
+        if best_W <= target:
+            break
+        if it & 255 == 0:
+            progress = it / iters
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                progress = max(progress, 1 - left / time_budget)
+            T = t_start * (t_end / t_start) ** progress
+        it += 1
+        cand_key = _mutate_key(key, alphabet, max_key_len, rng)
+        cand = build(cand_key)
+        changed = {i for i in range(n) if cand[i] != table[i]}
+        affected = changed | {(i - cols) % n for i in changed}
+        cand_terms = list(terms)
+        delta = 0.0
+        for i in affected:
+            Ptab = RUS_FREQ_TABLE.get(cand[i], 0.0)
+            cand_terms[i] = 0.0 if Ptab == 0.0 else (obs[cand[(i + cols) % n]] - Ptab) ** 2
+            delta += cand_terms[i] - terms[i]
+        if delta <= 0 or rng.random() < math.exp(-delta / T):
+            key, table, terms = cand_key, cand, cand_terms
+            W += delta
+            if W < best_W:
+                # накопленные дельты плывут — лучший W пересчитываем точно
+                W = sum(terms)
+                if W < best_W:
+                    best_W, best_key = W, "".join(key)
+    return best_W, best_key, it
+
+def anneal_trisemus(ciphertext: str, rows: int, alphabet: str,
+                    max_key_len: int = 12,
+                    restarts: int = 4,
+                    workers: int = 1,
+                    iters: int = 200000,
+                    time_budget: Optional[float] = None,
+                    target: float = 0.0,
+                    t_start: float = 1e-3,
+                    t_end: float = 1e-6,
+                    seed: Optional[int] = None,
+                    stats: Optional[Counter] = None) -> List[Tuple[float, str, str]]:
+    """Имитация отжига по ключам длины до max_key_len; restarts независимых запусков
+       (при workers > 1 — в разных процессах). Запуск останавливается по числу итераций,
+       по времени time_budget (секунды на запуск) или при W <= target.
+       Возвращает различные таблицы по возрастанию W; в stats добавляется iters."""
+    ciphertext = normalize_text(ciphertext, alphabet)
+    if len(alphabet) % rows != 0:
+        raise ValueError("Длина алфавита должна делиться на rows")
+    if max_key_len < 1:
+        raise ValueError("max_key_len должен быть не меньше 1")
+    # ключ длиннее алфавита невозможен: все буквы уже в таблице
+    max_key_len = min(max_key_len, len(alphabet))
+    if stats is None:
+        stats = Counter()
+    N = len(ciphertext)
+    if N == 0:
+        return []
+    counts = Counter(ciphertext)
+    ct_counts = {ch: counts[ch] for ch in alphabet}
+    base = random.randrange(1 << 30) if seed is None else seed
+    jobs = [(ct_counts, N, rows, alphabet, max_key_len, iters, time_budget, target, t_start, t_end, base + r)
+            for r in range(restarts)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            runs = list(ex.map(_anneal_run, jobs))
+    else:
+        runs = [_anneal_run(job) for job in jobs]
+    results = []
+    seen = set()
+    for W, k, it in sorted(runs):
+        stats["iters"] += it
+        if k in seen:
+            continue
+        seen.add(k)
+        results.append((W, k, Trisemus(alphabet=alphabet, key=k, rows=rows).decrypt(ciphertext)))
+    return results
 
 def main():
     parser = argparse.ArgumentParser()
     sub = parser.add_subparsers(dest="cmd")
 
     tparser = sub.add_parser("trisemus", help="Trisemus encrypt/decrypt/compare by W")
-    tparser.add_argument("--mode", choices=["encrypt", "decrypt", "analyze"], required=True)
+    tparser.add_argument("--mode", choices=["encrypt", "decrypt", "analyze", "anneal"], required=True)
     tparser.add_argument("--key", help="key filename (string of chars)")
-    tparser.add_argument("--key-template", help="key template with ? for unknowns (optional)")
+    tparser.add_argument("--key-template", nargs="+",
+                         help="key template(s) with ? for unknowns (optional; analyze tries each)")
     tparser.add_argument("--perm-chars", help="chars to permute (if key_template omitted, these are entire 6-letter key)")
-    tparser.add_argument("--rows", type=int, required=True, help="number of rows in table")
+    tparser.add_argument("--rows", type=int, nargs="+", required=True,
+                         help="number of rows in table (analyze accepts several, e.g. 5 7)")
     tparser.add_argument("--in", dest="infile", help="input filename (plaintext or ciphertext)")
     tparser.add_argument("--out", dest="outfile", help="output filename")
     tparser.add_argument("--top", type=int, default=10, help="top N results for analysis")
+    tparser.add_argument("--workers", type=int, default=1,
+                         help="analyze: number of processes (permutation index ranges are split between them)")
+    tparser.add_argument("--search", choices=["exhaustive", "bnb"], default="exhaustive",
+                         help="analyze: full enumeration or branch-and-bound pruning (bnb runs one process per configuration)")
+    tparser.add_argument("--score", choices=["W", "ngram"], default="W",
+                         help="analyze: unigram W or n-gram log-probability (needs --model)")
+    tparser.add_argument("--model", help="n-gram model file (.npy) built with build-model (memory-mapped)")
+    tparser.add_argument("--ngram-order", type=int, choices=[2, 3], default=3,
+                         help="analyze: bigram or trigram scoring from the model file")
+    tparser.add_argument("--max-key-len", type=int, default=12, help="anneal: maximum key length")
+    tparser.add_argument("--restarts", type=int, default=4, help="anneal: number of independent runs")
+    tparser.add_argument("--iters", type=int, default=200000, help="anneal: iterations per run")
+    tparser.add_argument("--time", type=float, help="anneal: time budget per run, seconds")
+    tparser.add_argument("--target", type=float, default=0.0, help="anneal: stop a run once W <= target")
+    tparser.add_argument("--seed", type=int, help="anneal: random seed")
     tparser.add_argument("--print_key", action="store_true", help="print table for given key")
 
+    mparser = sub.add_parser("build-model", help="train n-gram model from a corpus")
+    mparser.add_argument("--corpus", nargs="+", required=True,
+                         help="corpus filename(s), any text normalized to the alphabet; each file is a shard")
+    mparser.add_argument("--out", dest="outfile", required=True, help="output model filename (.npy)")
+    mparser.add_argument("--workers", type=int, default=1, help="number of processes (one shard per task)")
+
     args = parser.parse_args()
 
     if args.cmd == "trisemus":
+        if args.mode != "analyze" and len(args.rows) != 1:
+            print("Несколько --rows допускаются только в режиме analyze.")
+            return
         if args.mode in ("encrypt", "decrypt"):
             if not args.key or not args.infile or not args.outfile:
                 print("Укажите --key, --in и --out для шифрования/дешифрования.")
                 return
             key = read_file(args.key).strip()
-            txt = read_file(args.infile)
-            txt_norm = normalize_text(txt, ALPHABET)
-            tr = Trisemus(alphabet=ALPHABET, key=key, rows=args.rows)
+            tr = Trisemus(alphabet=ALPHABET, key=key, rows=args.rows[0])
             if args.mode == "encrypt":
-                ct = tr.encrypt(txt_norm)
-                write_file(args.outfile, ct)
+                tr.encrypt_file(args.infile, args.outfile)
                 print(f"Зашифровано -> {args.outfile}")
             else:
-                pt = tr.decrypt(txt_norm)
-                write_file(args.outfile, pt)
+                tr.decrypt_file(args.infile, args.outfile)
                 print(f"Расшифровано -> {args.outfile}")
 
         elif args.mode == "analyze":
             if not args.infile or not args.perm_chars:
                 print("Для анализа укажите --in и --perm-chars.")
                 return
+            if args.score == "ngram" and not args.model:
+                print("Для --score ngram укажите --model.")
+                return
+            if args.score == "ngram" and args.search == "bnb":
+                print("--search bnb работает только с --score W (нижняя оценка выведена для W).")
+                return
+            model = NgramModel.load(args.model, order=args.ngram_order) if args.score == "ngram" else None
             cipher_text = read_file(args.infile).strip()
-            top_results = analyze_trisemus_permutations(ciphertext=cipher_text,
-                                                        rows=args.rows,
-                                                        perm_chars=args.perm_chars,
-                                                        alphabet=ALPHABET,
-                                                        key_template=(args.key_template if args.key_template else None),
-                                                        top_n=args.top)
+            stats: Counter = Counter()
+            configs = [(rows, tpl) for rows in args.rows for tpl in (args.key_template or [None])]
+            top_results = analyze_trisemus_configs(ciphertext=cipher_text,
+                                                   configs=configs,
+                                                   perm_chars=args.perm_chars,
+                                                   alphabet=ALPHABET,
+                                                   top_n=args.top,
+                                                   workers=args.workers,
+                                                   stats=stats,
+                                                   search=args.search,
+                                                   model=model)
+            print(f"Кэш таблиц: оценено {stats['misses']}, повторных ключей пропущено {stats['hits']}")
+            if args.search == "bnb":
+                print(f"Ветви и границы: узлов {stats['nodes']}, отсечено поддеревьев {stats['pruned']}")
             if not top_results:
                 print("Ни одного валидного кандидата не найдено.")
                 return
-            for i, (W, k, pt) in enumerate(top_results, 1):
+            label = "W" if model is None else "H"
+            for i, (W, rows, k, pt) in enumerate(top_results, 1):
+                print(f"{i:2d} | {label}={W:.12e} | rows={rows} | key='{k}'")
+                print("    Часть текста:", pt[:300].replace("\n", " "), end="\n\n")
+            if args.outfile:
+                write_file(args.outfile, top_results[0][3])
+                print(f"\nЛучший вариант записан в {args.outfile} с ключом {top_results[0][2]} (rows={top_results[0][1]})")
+
+        elif args.mode == "anneal":
+            if not args.infile:
+                print("Для отжига укажите --in.")
+                return
+            if args.max_key_len < 1:
+                print("--max-key-len должен быть не меньше 1.")
+                return
+            cipher_text = read_file(args.infile).strip()
+            stats = Counter()
+            t0 = time.perf_counter()
+            results = anneal_trisemus(ciphertext=cipher_text,
+                                      rows=args.rows[0],
+                                      alphabet=ALPHABET,
+                                      max_key_len=args.max_key_len,
+                                      restarts=args.restarts,
+                                      workers=args.workers,
+                                      iters=args.iters,
+                                      time_budget=args.time,
+                                      target=args.target,
+                                      seed=args.seed,
+                                      stats=stats)
+            elapsed = time.perf_counter() - t0
+            if not results:
+                print("Пустой шифртекст.")
+                return
+            print(f"Итераций: {stats['iters']} за {elapsed:.2f} с ({stats['iters'] / max(elapsed, 1e-9):.0f} ключей/с)")
+            for i, (W, k, pt) in enumerate(results[:args.top], 1):
                 print(f"{i:2d} | W={W:.12e} | key='{k}'")
                 print("    Часть текста:", pt[:300].replace("\n", " "), end="\n\n")
             if args.outfile:
-                write_file(args.outfile, top_results[0][2])
-                print(f"\nЛучший вариант записан в {args.outfile} с ключом {top_results[0][1]}")
+                write_file(args.outfile, results[0][2])
+                print(f"\nЛучший вариант записан в {args.outfile} с ключом {results[0][1]}")
+
+    elif args.cmd == "build-model":
+        counts = build_ngram_counts(args.corpus, workers=args.workers)
+        save_ngram_counts(args.outfile, counts)
+        print(f"Модель записана в {args.outfile}: {int(counts[:len(ALPHABET)].sum())} символов")
 
     else:
         parser.print_help()